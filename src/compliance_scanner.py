@@ -1,25 +1,280 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
+import re
 import boto3
-import glob
+from botocore.config import Config
+from botocore.exceptions import ClientError, ParamValidationError
 import hashlib
-from datetime import datetime
+import heapq
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+# Compact JSON for machine-read payloads (S3 objects, cache files)
+_COMPACT_JSON = (',', ':')
+
+# Per-language CVE lookup rules in priority order (first match per line wins):
+# (any of these markers, all of these markers, pattern, NVD search keyword)
+_CVE_RULES = {
+    'Python': (
+        (('eval(', 'exec('), (), 'eval/exec injection', 'python eval exec injection'),
+        (('subprocess.call',), ('shell=True',), 'command injection', 'python subprocess shell injection'),
+        (('pickle.loads',), (), 'deserialization', 'python pickle deserialization'),
+    ),
+    'JavaScript': (
+        (('eval(',), (), 'eval injection', 'javascript eval injection'),
+        (('innerHTML',), ('+',), 'XSS vulnerability', 'javascript innerHTML XSS'),
+    ),
+}
+# One compiled sweep per language locates the lines worth classifying
+_CVE_TRIGGER_RE = {
+    language: re.compile('|'.join(re.escape(marker) for rule in rules for marker in rule[0]))
+    for language, rules in _CVE_RULES.items()
+}
+
+# Optional AI prefilter (AI_PREFILTER=true): files matching none of these
+# security-relevant patterns are not sent to Bedrock at all
+_RISKY_RE = re.compile(
+    rb'0\.0\.0\.0|privileged|runAs|AKIA[0-9A-Z]{16}|PRIVATE KEY|'
+    rb'allowPrivilegeEscalation|host(?:Network|PID|IPC|Path)|'
+    rb'resource|ingress|apiVersion|'
+    rb'passw(?:or)?d|secret|token|api[_-]?key|credential|'
+    rb'eval\(|exec\(|subprocess|shell=True|pickle|innerHTML|'
+    rb'http://|verify\s*=\s*False|chmod\s+777|md5|sha1',
+    re.IGNORECASE
+)
+
+# Prompt compaction for large IaC files: comment-only lines (dropped unless security-relevant),
+# and the security-relevant lines whose neighbourhood is kept for very large files.
+# Terms match as whole words or snake_case parts (DB_PASSWORD, AWS_SECRET_ACCESS_KEY)
+_COMMENT_PREFIXES = {'Kubernetes': ('#',), 'Terraform': ('#', '//')}
+_SECURITY_HINT_RE = re.compile(
+    r'(?<![^\W_])(ingress|egress|privileged|runAsUser|secret|password|passwd|token|api[_-]?key|'
+    r'credential|private key|AKIA[0-9A-Z]{16}|'
+    r'iam|policy|public|encryption|eval|exec|subprocess|pickle|sql)(?![^\W_])|0\.0\.0\.0/0',
+    re.IGNORECASE
+)
+
+# Artifacts stripped from AI-generated fixes in one pass: a leading "Here ...:" preamble,
+# opening code fences at any line start, and the closing fence at the end
+_FIX_ARTIFACTS_RE = re.compile(r'\A(?i:Here).*?:\s*|^```\w*\n|\n```(?=\n?\Z)', re.MULTILINE)
+
+# Languages recognised in a prompt header when building the focused KB query
+_KB_LANGUAGE_RE = re.compile(r'Python|JavaScript|Terraform|Kubernetes')
+
+# Scanned file extensions and their languages (also the order files are scanned in)
+_LANGUAGE_BY_EXT = {
+    '.py': 'Python', '.js': 'JavaScript', '.ts': 'TypeScript',
+    '.tf': 'Terraform', '.tfvars': 'Terraform',
+    '.yaml': 'Kubernetes', '.yml': 'Kubernetes',
+    '.java': 'Java', '.go': 'Go', '.sh': 'Shell'
+}
+
+# Python framework markers, found in one case-insensitive pass over the source
+_FRAMEWORK_RE = re.compile(r'django|flask|fastapi', re.IGNORECASE)
+
+# Whole code-fence lines in detection output
+_FENCE_LINE_RE = re.compile(r'^[^\S\n]*```[^\n]*\n?', re.MULTILINE)
+
+# Converse tool that makes the model return detected issues as structured input
+# (required: the fields every reported issue must carry)
+def _issues_tool_config(required):
+    return {
+        'tools': [{
+            'toolSpec': {
+                'name': 'report_issues',
+                'description': 'Report the security and compliance issues found in the code',
+                'inputSchema': {'json': {
+                    'type': 'object',
+                    'properties': {
+                        'issues': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': {
+                                    'file': {'type': 'string'},
+                                    'line': {'type': 'integer'},
+                                    'severity': {'type': 'string', 'enum': ['critical', 'high', 'medium', 'low']},
+                                    'category': {'type': 'string'},
+                                    'description': {'type': 'string'},
+                                    'cvss': {'type': 'number'},
+                                    'compliance_violations': {'type': 'array', 'items': {'type': 'string'}},
+                                    'remediation': {'type': 'string'},
+                                    'kb_rule': {'type': 'string'},
+                                    'rfc_document': {'type': 'string'},
+                                    'rule_source': {'type': 'string'}
+                                },
+                                'required': required
+                            }
+                        }
+                    },
+                    'required': ['issues']
+                }}
+            }
+        }],
+        'toolChoice': {'tool': {'name': 'report_issues'}}
+    }
+
+_ISSUES_TOOL_CONFIG = _issues_tool_config(['line', 'severity', 'description'])
+# Batch detection: every issue must name the file it belongs to
+_BATCH_ISSUES_TOOL_CONFIG = _issues_tool_config(['file', 'line', 'severity', 'description'])
+
+# Latency-optimized inference, as each Bedrock runtime API spells it
+_INVOKE_LATENCY_OPT = {'performanceConfigLatency': 'optimized'}
+_CONVERSE_LATENCY_OPT = {'performanceConfig': {'latency': 'optimized'}}
+
+# Pre-serialized invoke_model bodies; only max_tokens and the JSON-escaped prompt vary per call
+_CLAUDE_BODY_TMPL = (
+    b'{"anthropic_version":"bedrock-2023-05-31","max_tokens":%d,"temperature":0.1,"top_p":0.9,'
+    b'"messages":[{"role":"user","content":%b}]}'
+)
+_NOVA_BODY_TMPL = (
+    b'{"messages":[{"role":"user","content":[{"text":%b}]}],'
+    b'"inferenceConfig":{"maxTokens":%d,"temperature":0.1,"topP":0.9}}'
+)
+
+# Only "[" followed by "{" or "]" can open an array of objects; bounds the decode attempts per reply
+_JSON_ARRAY_START_RE = re.compile(r'\[\s*[{\]]')
+_MAX_JSON_ATTEMPTS = 20
+
+def _find_json_array(text, first_only=False):
+    """Return the first JSON array of objects in text, decoded in one linear pass per candidate.
+    
+    An empty array counts only as the first candidate: a later [] is nested in an outer
+    array that failed to decode (e.g. truncated output), not the answer.
+    first_only: try only the first candidate, i.e. the outermost array of the reply.
+    """
+    decoder = json.JSONDecoder()
+    for attempt, match in enumerate(_JSON_ARRAY_START_RE.finditer(text)):
+        if attempt == _MAX_JSON_ATTEMPTS or (first_only and attempt):
+            break
+        try:
+            value, _ = decoder.raw_decode(text, match.start())
+            if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+                return value if value or not attempt else None
+        except (ValueError, RecursionError):
+            pass  # Not JSON here, or nested too deeply to decode
+    return None
+
+def _validation_error_mentions(error, *terms):
+    """True if error is a request validation error whose message mentions one of terms (lowercase)"""
+    if isinstance(error, ClientError):
+        details = error.response.get('Error', {})
+        if details.get('Code') != 'ValidationException':
+            return False
+        message = details.get('Message', '')
+    else:
+        message = str(error)
+    message = message.lower()
+    return any(term in message for term in terms)
+
+class _TaskOutput:
+    """stdout proxy for parallel scans: each task's output is buffered and written in one piece"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+    
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            with self._lock:
+                return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+    
+    def flush(self):
+        if getattr(self._local, 'buffer', None) is None:
+            self.stream.flush()
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+    
+    @contextmanager
+    def task(self):
+        """Buffer this thread's output until the task finishes"""
+        self._local.buffer = []
+        try:
+            yield
+        finally:
+            text = ''.join(self._local.buffer)
+            self._local.buffer = None
+            with self._lock:
+                self.stream.write(text)
+                self.stream.flush()
 
 class ComplianceScanner:
-    def __init__(self, profile_name=None):
+    # Bump when detection/fix prompts change so cached results are re-scanned
+    PROMPT_VERSION = 1
+    
+    # Cost model: USD per token, precomputed from the per-1K-token prices
+    INPUT_COST_PER_TOKEN = 0.00035 / 1000
+    OUTPUT_COST_PER_TOKEN = 0.0014 / 1000
+    
+    # Files analyzed per run (cost limit) and the typical cost of such a run with no cache hits
+    MAX_FILES_PER_RUN = 10
+    UNCACHED_RUN_COST = 0.02
+    
+    def __init__(self, profile_name=None, use_cache=True):
         # Use AWS profile for local development, OIDC for GitHub Actions
         session = boto3.Session(profile_name=profile_name)
         self.region = os.getenv('AWS_REGION', 'us-east-1')
-        self.bedrock = session.client('bedrock-runtime', region_name=self.region)
+        
+        # Files are scanned concurrently; size the connection pool to match, keep
+        # connections alive between calls and let adaptive retries absorb throttling
+        # Default follows the usual I/O-bound sizing: 5 threads per CPU, capped at 32
+        self.max_workers = int(os.getenv('PARALLEL_WORKERS') or min(32, (os.cpu_count() or 4) * 5))
+        client_config = Config(
+            max_pool_connections=max(self.max_workers, 10),
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            connect_timeout=10,
+            tcp_keepalive=True
+        )
+        
+        # One client per service for the whole run, all from the same session
+        self.bedrock = session.client('bedrock-runtime', region_name=self.region, config=client_config)
+        self.bedrock_agent = session.client('bedrock-agent-runtime', region_name=self.region, config=client_config)
+        self.s3 = session.client('s3', region_name=self.region, config=client_config)
+        
+        # Small files of one language share a single detection call
+        self.batch_size = int(os.getenv('BATCH_SIZE', '4'))
+        self.batch_file_limit = 6000   # bytes; larger files are scanned on their own
+        self.batch_char_limit = 16000  # combined source per batch, keeps output within max_tokens
+        self.max_file_size = int(os.getenv('MAX_FILE_SIZE', '1048576'))  # bytes; larger files are skipped
+        
+        # Skip the AI scan for files with no security-relevant patterns (opt-in)
+        self.ai_prefilter = os.getenv('AI_PREFILTER', 'false').lower() == 'true'
+        
+        # Stream model output and stop reading once a JSON answer is complete (opt-in)
+        self.streaming = os.getenv('BEDROCK_STREAMING', 'false').lower() == 'true'
+        
+        # Latency-optimized inference; turned off for the run if the model/region rejects it
+        self.latency_optimized = os.getenv('BEDROCK_LATENCY_OPT', '1') == '1'
+        
+        # Detection via Converse tool use (structured issues); turned off for the run if unsupported
+        self.structured_output = os.getenv('BEDROCK_STRUCTURED_OUTPUT', 'true').lower() == 'true'
         self.kb_id = os.getenv('BEDROCK_KB_ID', 'RL3YC1HUKZ')
         self.model_id = os.getenv('BEDROCK_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
         self.ai_calls = 0
         self.total_cost = 0
-        
-        # File hash cache
+        self._stats_lock = threading.Lock()
+        self._nvd_lock = threading.Lock()  # NVD requests are paced run-wide, not per scan thread
+        self.incomplete_scans = set()  # files whose AI detection failed; their results are not cached
+        self.incomplete_cve_checks = set()  # files whose NVD lookup failed
+        self.cve_pending = {}  # file -> AI-detected issues, cached on their own until the CVE check succeeds
+        self.fixed_sources = {}  # file -> fixed bytes written this run, reused for identical files
+        
+        # File hash cache (use_cache=False ignores cached results but still refreshes them)
+        self.use_cache = use_cache
         self.cache_file = '.file_hash_cache.json'
+        self.cache_max_entries = int(os.getenv('CACHE_MAX_ENTRIES', '5000'))
         self.file_cache = self.load_cache()
+        self.run_started = datetime.now().isoformat()  # entries stamped since then were written this run
         self.ai_calls = 0
         self.total_cost = 0
         
@@ -78,9 +333,7 @@ class ComplianceScanner:
     
     def _single_kb_query(self, query):
         """Single KB query for normal-sized content"""
-        bedrock_agent = boto3.client('bedrock-agent-runtime', region_name=self.region)
-        
-        response = bedrock_agent.retrieve(
+        response = self.bedrock_agent.retrieve(
             knowledgeBaseId=self.kb_id,
             retrievalQuery={'text': query},
             retrievalConfiguration={
@@ -90,29 +343,28 @@ class ComplianceScanner:
             }
         )
         
-        context = ""
-        for result in response['retrievalResults']:
-            context += f"{result['content']['text']}\n\n"
+        context = '\n\n'.join(result['content']['text'] for result in response['retrievalResults']).strip()
         
-        if context.strip():
+        if context:
             print(f"   📚 KB Query successful - {len(response['retrievalResults'])} sources found")
-            return context.strip()
+            return context
         return None
     
     def _chunked_kb_query(self, query, chunk_size):
         """Multiple KB queries for large files"""
         chunks = []
-        lines = query.split('\n')
-        current_chunk = ""
-        
-        # Split into chunks by lines to maintain context
-        for line in lines:
-            if len(current_chunk + line + '\n') > chunk_size:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = line + '\n'
-            else:
-                current_chunk += line + '\n'
+        current_chunk = []
+        current_len = 0
+        
+        # Split into chunks by lines to maintain context (lengths tracked, strings joined once)
+        for line in query.split('\n'):
+            line_len = len(line) + 1
+            if current_len + line_len > chunk_size and current_chunk:
+                chunks.append(current_chunk)
+                current_chunk = []
+                current_len = 0
+            current_chunk.append(line)
+            current_len += line_len
         
         if current_chunk:
             chunks.append(current_chunk)
@@ -120,29 +372,61 @@ class ComplianceScanner:
         print(f"   📊 Processing {len(chunks)} chunks for comprehensive KB analysis")
         
         # Query each chunk and combine results
-        all_context = ""
-        total_sources = 0
+        contexts = []
         
         for i, chunk in enumerate(chunks[:3]):  # Limit to 3 chunks for cost control
-            chunk_context = self._single_kb_query(chunk)
+            chunk_context = self._single_kb_query('\n'.join(chunk) + '\n')
             if chunk_context:
-                all_context += f"--- Chunk {i+1} Context ---\n{chunk_context}\n\n"
-                total_sources += 1
+                contexts.append(f"--- Chunk {i+1} Context ---\n{chunk_context}")
         
-        if all_context:
-            print(f"   📚 Chunked KB Query successful - {total_sources} chunks analyzed")
-            return all_context.strip()
+        if contexts:
+            print(f"   📚 Chunked KB Query successful - {len(contexts)} chunks analyzed")
+            return '\n\n'.join(contexts)
         
         return None
     
-    def get_file_hash(self, filepath):
-        """Generate SHA256 hash of file content"""
+    def get_file_hash(self, filepath, data=None):
+        """Generate SHA256 hash of file content (data, if given, is the already-read content)"""
         try:
-            with open(filepath, 'rb') as f:
-                return hashlib.sha256(f.read()).hexdigest()
+            if data is None:
+                with open(filepath, 'rb') as f:
+                    data = f.read()
+            return hashlib.sha256(data).hexdigest()
         except Exception:
             return None
     
+    def read_source(self, filepath):
+        """Read a file once; returns (raw bytes, decoded text) or (None, None)"""
+        data = self.read_bytes(filepath)
+        if data is None:
+            return None, None
+        code = self.decode_source(filepath, data)
+        if code is None:
+            return None, None
+        return data, code
+    
+    def read_bytes(self, filepath):
+        """Read a file's raw bytes, or None if it cannot be read"""
+        try:
+            with open(filepath, 'rb') as f:
+                return f.read()
+        except Exception as e:
+            self.log_error(f"File read error: {e}")
+            return None
+    
+    def decode_source(self, filepath, data):
+        """Decode file bytes as UTF-8 text, or None if they are not valid UTF-8"""
+        try:
+            code = data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            self.log_error(f"File read error: {filepath}: {e}")
+            return None
+        
+        # Match text-mode universal newlines
+        if '\r' in code:
+            code = code.replace('\r\n', '\n').replace('\r', '\n')
+        return code
+    
     def load_cache(self):
         """Load file hash cache from local file or S3 (for CI/CD)"""
         cache = {}
@@ -168,10 +452,14 @@ class ComplianceScanner:
     
     def save_cache(self):
         """Save file hash cache to local file and S3 (for CI/CD)"""
-        # Save locally
+        self.evict_cache()
+        
+        # Save locally; write a temp file and swap it in so an interrupted save never truncates the cache
+        tmp_file = f"{self.cache_file}.tmp"
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.file_cache, f, indent=2)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.file_cache, f, separators=_COMPACT_JSON)
+            os.replace(tmp_file, self.cache_file)
         except Exception as e:
             print(f"⚠️ Local cache save failed: {e}")
         
@@ -185,8 +473,7 @@ class ComplianceScanner:
             s3_bucket = os.getenv('S3_CACHE_BUCKET', 'ai-security-scanner-cache')
             cache_key = f"cache/{os.getenv('GITHUB_REPOSITORY', 'default')}/file_hash_cache.json"
             
-            s3 = boto3.client('s3', region_name=self.region)
-            response = s3.get_object(Bucket=s3_bucket, Key=cache_key)
+            response = self.s3.get_object(Bucket=s3_bucket, Key=cache_key)
             cache_data = json.loads(response['Body'].read())
             
             # Clean old cache entries (older than 7 days)
@@ -212,11 +499,10 @@ class ComplianceScanner:
             s3_bucket = os.getenv('S3_CACHE_BUCKET', 'ai-security-scanner-cache')
             cache_key = f"cache/{os.getenv('GITHUB_REPOSITORY', 'default')}/file_hash_cache.json"
             
-            s3 = boto3.client('s3', region_name=self.region)
-            s3.put_object(
+            self.s3.put_object(
                 Bucket=s3_bucket,
                 Key=cache_key,
-                Body=json.dumps(self.file_cache, indent=2),
+                Body=json.dumps(self.file_cache, separators=_COMPACT_JSON),
                 ContentType='application/json'
             )
             print(f"📋 Saved cache to S3: s3://{s3_bucket}/{cache_key}")
@@ -224,33 +510,74 @@ class ComplianceScanner:
         except Exception as e:
             print(f"⚠️ S3 cache save failed: {e}")
     
-    def get_cached_result(self, filepath):
-        """Get cached result if file hasn't changed"""
-        current_hash = self.get_file_hash(filepath)
+    def evict_cache(self):
+        """Drop entries beyond the size cap: deleted/renamed files first, then the
+        least-frequently-hit (oldest first on ties). Results written this run have no
+        hits yet, so they are kept ahead of older entries."""
+        excess = len(self.file_cache) - self.cache_max_entries
+        if excess <= 0:
+            return
+        
+        def retention(key):
+            entry = self.file_cache[key]
+            timestamp = entry.get('timestamp', '')
+            return (os.path.exists(key), timestamp >= self.run_started, entry.get('hits', 0), timestamp)
+        
+        victims = heapq.nsmallest(excess, self.file_cache, key=retention)
+        for key in victims:
+            del self.file_cache[key]
+        print(f"📋 Evicted {len(victims)} least-used cache entries")
+    
+    def get_cache_entry(self, filepath, file_hash=None):
+        """Get the cache entry if file, model and prompts haven't changed.
+        
+        A hit with result None means the file was scanned and found clean.
+        """
+        if not self.use_cache:
+            return None
+        
+        current_hash = file_hash or self.get_file_hash(filepath)
         if not current_hash:
             return None
         
         cache_key = filepath
         if cache_key in self.file_cache:
             cached_data = self.file_cache[cache_key]
-            if cached_data.get('hash') == current_hash:
-                return cached_data.get('result')
+            if (cached_data.get('hash') == current_hash
+                    and cached_data.get('model') == self.model_id
+                    and cached_data.get('prompt_version') == self.PROMPT_VERSION):
+                cached_data['hits'] = cached_data.get('hits', 0) + 1
+                return cached_data
         
         return None
     
-    def cache_result(self, filepath, result):
-        """Cache scan result with file hash"""
-        file_hash = self.get_file_hash(filepath)
+    def cache_result(self, filepath, result, file_hash=None, detection=None):
+        """Cache scan result with file hash.
+        
+        detection (AI-detected issues) marks a scan whose CVE check failed: the next run
+        reuses the detection and only repeats the CVE check.
+        """
+        file_hash = file_hash or self.get_file_hash(filepath)
         if file_hash:
             self.file_cache[filepath] = {
                 'hash': file_hash,
+                'model': self.model_id,
+                'prompt_version': self.PROMPT_VERSION,
                 'result': result,
+                'hits': 0,
                 'timestamp': datetime.now().isoformat()
             }
+            if detection is not None:
+                self.file_cache[filepath]['detection'] = detection
     
     
-    def call_ai_with_compliance(self, prompt):
-        """AI call with MANDATORY Knowledge Base compliance context"""
+    def call_ai_with_compliance(self, prompt, max_tokens=3000, json_output=False, tool_config=_ISSUES_TOOL_CONFIG):
+        """AI call with MANDATORY Knowledge Base compliance context.
+        
+        Returns (output, stop_reason): the model text, or for json_output calls answered
+        through tool use (tool_config), the issues list. stop_reason is 'max_tokens' when
+        the output was cut off (None if not reported); (None, None) if the call failed.
+        """
         
         # ENFORCE: Knowledge Base must be available
         if not self.kb_id:
@@ -283,65 +610,166 @@ Analyze this code using ONLY KB context:
 """
         
         try:
+            # Detection calls: ask for the issues as structured tool input
+            if json_output and self.structured_output:
+                structured = self._converse_issues(compliance_prompt, max_tokens, tool_config)
+                if structured is not None:
+                    return structured
+            
             # Different API formats for different models
-            if 'anthropic' in self.model_id:
-                # Claude format
-                response = self.bedrock.invoke_model(
-                    modelId=self.model_id,
-                    body=json.dumps({
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 3000,
-                        "temperature": 0.1,
-                        "top_p": 0.9,
-                        "messages": [{"role": "user", "content": compliance_prompt}]
-                    })
-                )
-                
-                self.ai_calls += 1
-                result = json.loads(response['body'].read())
-                output = result['content'][0]['text'].strip()
-                
+            claude = 'anthropic' in self.model_id
+            prompt_json = json.dumps(compliance_prompt).encode('utf-8')
+            if claude:
+                body = _CLAUDE_BODY_TMPL % (max_tokens, prompt_json)
             else:
-                # Nova format
-                response = self.bedrock.invoke_model(
-                    modelId=self.model_id,
-                    body=json.dumps({
-                        "messages": [{"role": "user", "content": [{"text": compliance_prompt}]}],
-                        "inferenceConfig": {"maxTokens": 3000, "temperature": 0.1, "topP": 0.9}
-                    })
-                )
-                
-                self.ai_calls += 1
+                body = _NOVA_BODY_TMPL % (prompt_json, max_tokens)
+            
+            input_tokens = output_tokens = stop_reason = None
+            if self.streaming:
+                response = self._invoke_model(self.bedrock.invoke_model_with_response_stream, _INVOKE_LATENCY_OPT, body=body)
+                with self._stats_lock:
+                    self.ai_calls += 1
+                output, stop_reason = self._read_stream(response['body'], claude, json_output)
+                output = output.strip()
+            else:
+                response = self._invoke_model(self.bedrock.invoke_model, _INVOKE_LATENCY_OPT, body=body)
+                with self._stats_lock:
+                    self.ai_calls += 1
                 result = json.loads(response['body'].read())
-                output = result['output']['message']['content'][0]['text'].strip()
+                if claude:
+                    output = result['content'][0]['text'].strip()
+                    stop_reason = result.get('stop_reason')
+                else:
+                    output = result['output']['message']['content'][0]['text'].strip()
+                    stop_reason = result.get('stopReason')
+                
+                # Claude reports input_tokens/output_tokens, Nova inputTokens/outputTokens
+                usage = result.get('usage', {})
+                input_tokens = usage.get('input_tokens', usage.get('inputTokens'))
+                output_tokens = usage.get('output_tokens', usage.get('outputTokens'))
             
-            # Calculate cost
-            input_tokens = len(compliance_prompt) / 4
-            output_tokens = len(output) / 4
-            self.total_cost += (input_tokens * 0.00035 / 1000) + (output_tokens * 0.0014 / 1000)
+            # Calculate cost from reported usage; estimate (~4 chars/token) when it is unavailable
+            if input_tokens is None:
+                input_tokens = len(compliance_prompt) / 4
+            if output_tokens is None:
+                output_tokens = len(output) / 4
+            self._add_cost(input_tokens, output_tokens)
             
-            return output
+            return output, stop_reason
             
         except Exception as e:
             self.log_error(str(e))
+            return None, None
+    
+    def _add_cost(self, input_tokens, output_tokens):
+        with self._stats_lock:
+            self.total_cost += input_tokens * self.INPUT_COST_PER_TOKEN + output_tokens * self.OUTPUT_COST_PER_TOKEN
+    
+    def _converse_issues(self, compliance_prompt, max_tokens, tool_config=_ISSUES_TOOL_CONFIG):
+        """Detect via the Converse API with a forced report_issues tool.
+        
+        Returns (issues, stop_reason), or None to fall back to text.
+        """
+        converse = getattr(self.bedrock, 'converse', None)
+        if converse is None:
+            # boto3 older than 1.34.116 has no Converse API
+            self.structured_output = False
+            print("⚠️ Structured output needs boto3>=1.34.116, using text responses")
+            return None
+        
+        try:
+            response = self._invoke_model(
+                converse, _CONVERSE_LATENCY_OPT,
+                messages=[{'role': 'user', 'content': [{'text': compliance_prompt}]}],
+                inferenceConfig={'maxTokens': max_tokens, 'temperature': 0.1, 'topP': 0.9},
+                toolConfig=tool_config
+            )
+        except (ClientError, ParamValidationError) as e:
+            # Other validation errors (e.g. input too long) fail this call only
+            if not _validation_error_mentions(e, 'tool'):
+                raise
+            # Model without tool use support, or botocore without toolConfig
+            self.structured_output = False
+            print(f"⚠️ Structured output unavailable for {self.model_id}, using text responses")
             return None
+        
+        with self._stats_lock:
+            self.ai_calls += 1
+        usage = response.get('usage', {})
+        self._add_cost(usage.get('inputTokens', 0), usage.get('outputTokens', 0))
+        
+        for block in response['output']['message']['content']:
+            if 'toolUse' in block:
+                issues = block['toolUse']['input'].get('issues')
+                if isinstance(issues, list):
+                    return issues, response.get('stopReason')
+        return None
+    
+    def _invoke_model(self, invoke, latency_opt, **request):
+        """Call invoke, adding its latency-optimized setting where the model supports it"""
+        if self.latency_optimized:
+            try:
+                return invoke(modelId=self.model_id, **request, **latency_opt)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ValidationException':
+                    raise
+            except ParamValidationError:
+                pass  # botocore may predate the setting
+            
+            # The error text doesn't reliably say what was rejected: retry once without the
+            # setting, and only if that succeeds was it the cause (a failing retry raises as usual)
+            response = invoke(modelId=self.model_id, **request)
+            if self.latency_optimized:
+                self.latency_optimized = False
+                print(f"⚠️ Latency-optimized inference unavailable for {self.model_id}, using standard")
+            return response
+        
+        return invoke(modelId=self.model_id, **request)
+    
+    def _read_stream(self, stream, claude, json_output=False):
+        """Collect streamed model text and the stop reason (None if the stream was closed early
+        once a JSON array was complete)"""
+        parts = []
+        stop_reason = None
+        try:
+            for event in stream:
+                chunk = event.get('chunk')
+                if not chunk:
+                    continue
+                payload = json.loads(chunk['bytes'])
+                if claude:
+                    text = payload.get('delta', {}).get('text', '') if payload.get('type') == 'content_block_delta' else ''
+                    if payload.get('type') == 'message_delta':
+                        stop_reason = payload['delta'].get('stop_reason')
+                else:
+                    text = payload.get('contentBlockDelta', {}).get('delta', {}).get('text', '')
+                    if 'messageStop' in payload:
+                        stop_reason = payload['messageStop'].get('stopReason')
+                if not text:
+                    continue
+                parts.append(text)
+                
+                # Only re-check when an array could just have closed; nested arrays
+                # (e.g. "compliance_violations": []) close long before the answer does
+                if json_output and ']' in text and _find_json_array(''.join(parts), first_only=True) is not None:
+                    break
+        finally:
+            stream.close()
+        return ''.join(parts), stop_reason
     
     def _extract_kb_query_terms(self, prompt):
         """Extract key terms for KB query instead of sending full prompt"""
-        # Extract language and key security terms from prompt
-        lines = prompt.split('\n')
-        
-        # Find language
-        language = "unknown"
-        for line in lines[:10]:
-            if 'Python' in line:
-                language = "Python"
-            elif 'JavaScript' in line:
-                language = "JavaScript"
-            elif 'Terraform' in line:
-                language = "Terraform"
-            elif 'Kubernetes' in line:
-                language = "Kubernetes"
+        # Only the first 10 lines are inspected; find their end without splitting the whole prompt
+        head_end = -1
+        for _ in range(10):
+            head_end = prompt.find('\n', head_end + 1)
+            if head_end == -1:
+                head_end = len(prompt)
+                break
+        
+        # Find language (last mention in the header wins)
+        languages = _KB_LANGUAGE_RE.findall(prompt, 0, head_end)
+        language = languages[-1] if languages else "unknown"
         
         # Create focused KB query
         kb_query = f"{language} security compliance standards hardcoded secrets SQL injection encryption access control"
@@ -350,32 +778,24 @@ Analyze this code using ONLY KB context:
     
     def detect_language_and_framework(self, filepath, code):
         """Detect language and framework"""
-        ext_map = {
-            '.py': 'Python', '.js': 'JavaScript', '.ts': 'TypeScript',
-            '.tf': 'Terraform', '.tfvars': 'Terraform',
-            '.yaml': 'Kubernetes', '.yml': 'Kubernetes',
-            '.java': 'Java', '.go': 'Go', '.sh': 'Shell'
-        }
-        
-        language = ext_map.get(os.path.splitext(filepath)[1], 'Unknown')
+        language = _LANGUAGE_BY_EXT.get(os.path.splitext(filepath)[1], 'Unknown')
         
-        # Detect framework
+        # Detect framework (one scan records every marker; Django > Flask > FastAPI)
         framework = None
         if language == 'Python':
-            if 'django' in code.lower(): framework = 'Django'
-            elif 'flask' in code.lower(): framework = 'Flask'
-            elif 'fastapi' in code.lower(): framework = 'FastAPI'
+            found = {m.lower() for m in _FRAMEWORK_RE.findall(code)}
+            if 'django' in found: framework = 'Django'
+            elif 'flask' in found: framework = 'Flask'
+            elif 'fastapi' in found: framework = 'FastAPI'
         
         return language, framework
     
     def query_kb_for_rules(self, code_snippet, language):
         """Query your KB to get specific RFC rules for the code"""
         try:
-            bedrock_agent = boto3.client('bedrock-agent-runtime', region_name=self.region)
-            
             query = f"What security rules apply to this {language} code? {code_snippet[:500]}"
             
-            response = bedrock_agent.retrieve_and_generate(
+            response = self.bedrock_agent.retrieve_and_generate(
                 input={'text': query},
                 retrieveAndGenerateConfiguration={
                     'type': 'KNOWLEDGE_BASE',
@@ -413,13 +833,47 @@ Analyze this code using ONLY KB context:
                 'rfc_sources': []
             }
     
+    def _numbered_code(self, code, language):
+        """Number source lines for the prompt, compacting large files to cut input tokens.
+        
+        Blank lines are dropped for every language; comment stripping and windowing apply
+        to IaC only, so source code always reaches the detector in full. Lines keep their
+        original numbers, so reported line numbers stay exact.
+        """
+        numbered = list(enumerate(code.split('\n'), 1))
+        
+        if len(code) > 2048:
+            # Blank and IaC comment-only lines carry little signal, unless a comment holds
+            # something security-relevant (e.g. a commented-out credential)
+            prefixes = _COMMENT_PREFIXES.get(language, ())
+            numbered = [(n, line) for n, line in numbered
+                        if line.strip() and (not prefixes or not line.lstrip().startswith(prefixes)
+                                             or _SECURITY_HINT_RE.search(line))]
+            
+            # Still large IaC: keep only +/-30 lines around security-relevant lines
+            if prefixes and sum(len(line) + 1 for _, line in numbered) > 8000:
+                hits = [i for i, (_, line) in enumerate(numbered) if _SECURITY_HINT_RE.search(line)]
+                if hits:
+                    keep = set()
+                    for i in hits:
+                        keep.update(range(max(0, i - 30), min(len(numbered), i + 31)))
+                    windowed = []
+                    for i in sorted(keep):
+                        if i > 0 and i - 1 not in keep:
+                            windowed.append(None)  # gap marker
+                        windowed.append(numbered[i])
+                    if len(numbered) - 1 not in keep:
+                        windowed.append(None)
+                    return '\n'.join('    ...' if item is None else f"{item[0]:3d}: {item[1]}" for item in windowed)
+        
+        return '\n'.join(f"{n:3d}: {line}" for n, line in numbered)
+    
     def compliance_detect(self, code, language, framework, filepath):
         """Compliance-focused detection using AI with KB integration"""
         framework_text = f"/{framework}" if framework else ""
         
         # Add line numbers to code for accuracy
-        lines = code.split('\n')
-        numbered_code = '\n'.join([f"{i+1:3d}: {line}" for i, line in enumerate(lines)])
+        numbered_code = self._numbered_code(code, language)
         
         # Query your KB for relevant RFC rules
         kb_info = self.query_kb_for_rules(code, language)
@@ -451,50 +905,15 @@ Code from {filepath} with line numbers:
 
 Return ONLY the JSON array."""
 
-        output = self.call_ai_with_compliance(prompt)
-        if not output:
-            return []
-        
-        try:
-            # Clean and extract JSON
-            output = output.strip()
-            if '```' in output:
-                lines_out = output.split('\n')
-                output = '\n'.join([l for l in lines_out if not l.strip().startswith('```')])
-            
-            if '[' in output and ']' in output:
-                json_start = output.index('[')
-                json_end = output.rindex(']') + 1
-                json_str = output[json_start:json_end]
-                issues = json.loads(json_str)
-                
-                # Validate issues and add S3 source information
-                valid_issues = []
-                for issue in issues:
-                    if isinstance(issue, dict) and 'line' in issue and 'severity' in issue:
-                        # Add S3 source information from KB query
-                        if kb_info['rfc_sources']:
-                            issue['s3_sources'] = kb_info['rfc_sources']
-                            # Extract document names from S3 paths
-                            doc_names = []
-                            for s3_path in kb_info['rfc_sources']:
-                                if 's3://' in s3_path:
-                                    doc_name = s3_path.split('/')[-1]  # Get filename
-                                    doc_names.append(doc_name)
-                                elif s3_path:  # Any other path format
-                                    doc_names.append(s3_path)
-                            if doc_names:
-                                issue['rfc_document'] = ', '.join(doc_names)
-                        
-                        valid_issues.append(issue)
-                
-                return valid_issues
-                
-        except Exception as e:
-            self.log_error(f"JSON parse error: {e}")
-            return []  # Pure AI - no hardcoded fallback patterns
+        output, stop_reason = self.call_ai_with_compliance(prompt, json_output=True)
+        if output is None:
+            return None
+        if stop_reason == 'max_tokens':
+            # A cut-off issue list may parse as clean; never cache it as such
+            self.log_error(f"Detection truncated at max_tokens: {filepath}")
+            return None
         
-        return []
+        return self._parse_issues(output, kb_info)  # Pure AI - no hardcoded fallback patterns; None if unparseable
     
         
         # Save fixed code to temp file for validation
@@ -587,8 +1006,127 @@ Return ONLY the JSON array."""
             except:
                 pass
     
+    def compliance_detect_batch(self, files):
+        """Compliance detection for several small files of one language in a single AI call"""
+        sources = []
+        for filepath, code in files:
+            language, framework = self.detect_language_and_framework(filepath, code)
+            sources.append((filepath, code, framework))
+        
+        print(f"🔍 Compliance scanning {len(sources)} {language} files in one batch...")
+        
+        # One KB lookup serves the whole batch (same language). query_kb_for_rules reads
+        # only the first 500 characters, so each file contributes an equal head slice.
+        head = (500 - len(sources) + 1) // len(sources)
+        kb_info = self.query_kb_for_rules('\n'.join(code[:head] for _, code, _ in sources), language)
+        kb_context = ""
+        if kb_info['kb_guidance']:
+            kb_context = f"\nKnowledge Base Guidance:\n{kb_info['kb_guidance']}\n"
+        
+        file_sections = []
+        for filepath, code, framework in sources:
+            framework_text = f"/{framework}" if framework else ""
+            numbered_code = self._numbered_code(code, language)
+            file_sections.append(f"=== FILE: {filepath} ({language}{framework_text}) ===\n```\n{numbered_code}\n```")
+        files_text = '\n\n'.join(file_sections)
+        
+        prompt = f"""You are a security expert with access to RFC documents and compliance standards.
+
+{kb_context}
+
+Analyze each of the following {language} files for compliance violations using the KB guidance above.
+
+CRITICAL: Use EXACT line numbers from the numbered code of each file. Reference specific RFC documents when applicable.
+
+Return ONE JSON array covering all files:
+[{{"file": "<exact_file_path_from_FILE_header>", "line": <exact_line_number>, "severity": "critical|high|medium|low", 
+"category": "<type>", "description": "<what_you_found>", "cvss": <score>, 
+"compliance_violations": ["<standard>"], "remediation": "<fix>",
+"kb_rule": "<specific_RFC_rule_from_KB>",
+"rfc_document": "<RFC_document_name_from_S3>",
+"rule_source": "<RFC_section_or_standard>"}}]
+
+{files_text}
+
+Return ONLY the JSON array."""
+
+        output, stop_reason = self.call_ai_with_compliance(prompt, max_tokens=4000, json_output=True,
+                                                           tool_config=_BATCH_ISSUES_TOOL_CONFIG)
+        if output is None:
+            return None
+        if stop_reason == 'max_tokens':
+            # Truncated: the files are rescanned individually
+            self.log_error("Batch detection truncated at max_tokens")
+            return None
+        
+        issues = self._parse_issues(output, kb_info)
+        if issues is None:
+            return None
+        
+        # Route each issue back to its file; the model may echo "./a.py" for "a.py".
+        # An issue that matches no file would be lost, so the batch is rescanned per file instead.
+        issues_by_file = {filepath: [] for filepath, _ in files}
+        by_path = {os.path.normpath(filepath): filepath for filepath in issues_by_file}
+        for issue in issues:
+            filepath = issue.pop('file', None)
+            if not isinstance(filepath, str) or os.path.normpath(filepath) not in by_path:
+                self.log_error(f"Batch issue for unknown file {filepath!r}")
+                return None
+            issues_by_file[by_path[os.path.normpath(filepath)]].append(issue)
+        
+        return issues_by_file
+    
+    def _parse_issues(self, output, kb_info):
+        """Extract validated issues from AI output; None if no JSON array could be parsed"""
+        try:
+            if isinstance(output, list):
+                issues = output  # Structured tool output, already parsed
+            else:
+                # Clean and extract JSON
+                output = output.strip()
+                if '```' in output:
+                    output = _FENCE_LINE_RE.sub('', output)
+                
+                issues = self._extract_json_array(output)
+            if issues is not None:
+                # Validate issues and add S3 source information
+                valid_issues = []
+                for issue in issues:
+                    if isinstance(issue, dict) and 'line' in issue and 'severity' in issue:
+                        # Add S3 source information from KB query
+                        if kb_info['rfc_sources']:
+                            issue['s3_sources'] = kb_info['rfc_sources']
+                            # Extract document names from S3 paths
+                            doc_names = []
+                            for s3_path in kb_info['rfc_sources']:
+                                if 's3://' in s3_path:
+                                    doc_name = s3_path.split('/')[-1]  # Get filename
+                                    doc_names.append(doc_name)
+                                elif s3_path:  # Any other path format
+                                    doc_names.append(s3_path)
+                            if doc_names:
+                                issue['rfc_document'] = ', '.join(doc_names)
+                        
+                        valid_issues.append(issue)
+                
+                return valid_issues
+                
+        except Exception as e:
+            self.log_error(f"JSON parse error: {e}")
+        
+        return None
+    
+    def _extract_json_array(self, text):
+        """Return the first JSON array of objects in text, or log and return None"""
+        value = _find_json_array(text)
+        if value is not None:
+            return value
+        
+        self.log_error("JSON parse error: no JSON array found in AI output")
+        return None
+    
     def compliance_fix(self, code, issues, language, framework):
-        """Generate compliance-focused fixes"""
+        """Generate compliance-focused fixes; returns None unless the output is a real change"""
         framework_text = f"/{framework}" if framework else ""
         
         issues_desc = '\n'.join([
@@ -614,38 +1152,51 @@ Original code:
 
 Return ONLY the complete fixed code without any explanation comments. Do not add comments explaining the fixes:"""
 
-        fixed = self.call_ai_with_compliance(prompt)
+        # The fix restates the file, so output scales with its size (~3 bytes/token plus headroom)
+        max_tokens = max(512, min(4000, len(code.encode('utf-8')) // 3 + 256))
+        fixed, stop_reason = self.call_ai_with_compliance(prompt, max_tokens=max_tokens)
         if not fixed:
             return None
+        if stop_reason == 'max_tokens':
+            # A cut-off file must never be written over the source
+            print(f"   ⚠️ Fix truncated at {max_tokens} tokens - file left unchanged")
+            return None
         
-        # Clean output
-        import re
-        fixed = re.sub(r'^```[\w]*\n', '', fixed, flags=re.MULTILINE)
-        fixed = re.sub(r'\n```$', '', fixed)
-        fixed = re.sub(r'^Here.*?:\s*', '', fixed, flags=re.IGNORECASE)
+        # Clean output; most responses are bare code, so check for the literals first
+        if '```' in fixed or fixed[:4].lower() == 'here':
+            fixed = _FIX_ARTIFACTS_RE.sub('', fixed)
+        fixed = fixed.strip()
         
-        return fixed.strip()
-    
-    def scan_file(self, filepath, auto_fix=False):
-        """Scan file with compliance focus"""
-        try:
-            with open(filepath, 'r') as f:
-                code = f.read()
-        except Exception as e:
-            self.log_error(f"File read error: {e}")
+        if len(fixed) <= 50 or fixed == code:
             return None
+        return fixed
+    
+    def scan_file(self, filepath, auto_fix=False, issues=None, code=None):
+        """Scan file with compliance focus (issues may be pre-detected by a batch call)"""
+        if code is None:
+            _, code = self.read_source(filepath)
+            if code is None:
+                return None
         
         language, framework = self.detect_language_and_framework(filepath, code)
         if language == 'Unknown':
             return None
         
-        print(f"🔍 Compliance scanning {filepath} ({language}{f'/{framework}' if framework else ''})...")
-        
         # Compliance-focused detection
-        issues = self.compliance_detect(code, language, framework, filepath)
+        if issues is None:
+            print(f"🔍 Compliance scanning {filepath} ({language}{f'/{framework}' if framework else ''})...")
+            issues = self.compliance_detect(code, language, framework, filepath)
+            if issues is None:
+                # Report what the CVE checks find, but don't cache an incomplete scan
+                with self._stats_lock:
+                    self.incomplete_scans.add(filepath)
+                issues = []
         
         # CVE pattern checking (separate from compliance)
         cve_issues = self.check_code_cves(code, language, filepath)
+        if filepath in self.incomplete_cve_checks and filepath not in self.incomplete_scans:
+            with self._stats_lock:
+                self.cve_pending[filepath] = issues
         
         # Combine issues but keep them categorized
         all_issues = issues + cve_issues
@@ -669,12 +1220,13 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             print(f"   🔧 Compliance-focused AI fixing...")
             # Only fix compliance issues, not CVE patterns (they need code changes)
             compliance_issues = [i for i in all_issues if i.get('type') != 'cve_pattern']
-            if compliance_issues:
-                fixed_code = self.compliance_fix(code, compliance_issues, language, framework)
+            fixed_code = self.compliance_fix(code, compliance_issues, language, framework) if compliance_issues else None
             
-            if fixed_code and len(fixed_code) > 50 and fixed_code != code:
-                with open(filepath, 'w') as f:
-                    f.write(fixed_code)
+            if fixed_code is not None:
+                fixed_data = fixed_code.encode('utf-8')
+                self.write_file_atomic(filepath, fixed_data)
+                with self._stats_lock:
+                    self.fixed_sources[filepath] = fixed_data
                 fixed = True
                 print(f"   ✅ Applied AI-generated compliance fixes")
         
@@ -687,6 +1239,58 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             'compliance_violations': list(compliance_violations)
         }
     
+    def write_file_atomic(self, filepath, data):
+        """Replace a file's contents via a temp file, so a crash never leaves it half-written"""
+        # Write a symlink's target; replacing the path itself would turn the link into a copy
+        filepath = os.path.realpath(filepath)
+        # A unique sibling: same filesystem for os.replace, and never an existing user file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.',
+                                        prefix=f".{os.path.basename(filepath)}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, os.stat(filepath).st_mode & 0o7777)  # keep e.g. executable scripts executable
+            os.replace(tmp_path, filepath)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _plan_scan_batches(self, files, codes):
+        """Group small files of the same language so they share one detection call"""
+        batches = []
+        open_batches = {}  # language -> (files, total size)
+        for f in files:
+            language, _ = self.detect_language_and_framework(f, '')
+            size = len(codes[f])
+            
+            if self.batch_size < 2 or size > self.batch_file_limit:
+                batches.append([f])
+                continue
+            
+            group, total = open_batches.get(language, ([], 0))
+            if group and (len(group) >= self.batch_size or total + size > self.batch_char_limit):
+                batches.append(group)
+                group, total = [], 0
+            group.append(f)
+            open_batches[language] = (group, total + size)
+        
+        batches.extend(group for group, _ in open_batches.values())
+        return batches
+    
+    def _scan_batch(self, group, codes, auto_fix=False, detections=None):
+        """Scan a group of files, sharing one detection call when there are several
+        (detections: file -> issues already detected by an earlier run)"""
+        if detections and group[0] in detections:
+            return [self.scan_file(f, auto_fix, issues=detections[f], code=codes[f]) for f in group]
+        if len(group) > 1:
+            issues_by_file = self.compliance_detect_batch([(f, codes[f]) for f in group])
+            if issues_by_file is not None:
+                return [self.scan_file(f, auto_fix, issues=issues_by_file[f], code=codes[f]) for f in group]
+            print(f"   ⚠️ Batch detection failed - scanning {len(group)} files individually")
+        
+        return [self.scan_file(f, auto_fix, code=codes[f]) for f in group]
+    
     def upload_to_s3(self, report):
         """Upload report to S3 for web dashboard"""
         s3_bucket = os.getenv('REPORTS_S3_BUCKET', 'ai-security-scanner-reports-1759503117')
@@ -694,16 +1298,18 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             return
         
         try:
-            s3 = boto3.client('s3', region_name=self.region)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            s3 = self.s3
+            # UTC timestamp prefix keeps lexicographic key order chronological
+            timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
             key = f"reports/{timestamp}_compliance_report.json"
             
             # Upload report
             s3.put_object(
                 Bucket=s3_bucket,
                 Key=key,
-                Body=json.dumps(report, indent=2),
-                ContentType='application/json'
+                Body=json.dumps(report, separators=_COMPACT_JSON).encode('utf-8'),
+                ContentType='application/json',
+                ServerSideEncryption='AES256'
             )
             
             # Update manifest with latest 10 reports
@@ -716,20 +1322,13 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
     def update_reports_manifest(self, s3, bucket, new_report_key):
         """Update reports manifest to show latest 10 reports"""
         try:
-            # List all reports from S3 (more reliable than manifest)
-            response = s3.list_objects_v2(Bucket=bucket, Prefix='reports/')
-            reports = []
-            
-            for obj in response.get('Contents', []):
-                if obj['Key'].endswith('.json'):
-                    reports.append({
-                        'key': obj['Key'],
-                        'timestamp': obj['LastModified']
-                    })
-            
-            # Sort by timestamp (newest first) and keep latest 10
-            reports.sort(key=lambda x: x['timestamp'], reverse=True)
-            latest_reports = [r['key'] for r in reports[:10]]
+            # Report keys are timestamp-prefixed, so key order is chronological.
+            # List only recent keys first and fall back to a full listing when
+            # the recent window holds fewer than 10 reports.
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y%m%d')
+            latest_reports = self._latest_report_keys(s3, bucket, start_after=f"reports/{cutoff}")
+            if len(latest_reports) < 10:
+                latest_reports = self._latest_report_keys(s3, bucket)
             
             # Update manifest
             manifest = {"reports": latest_reports}
@@ -737,8 +1336,9 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             s3.put_object(
                 Bucket=bucket,
                 Key='reports-manifest.json',
-                Body=json.dumps(manifest, indent=2),
-                ContentType='application/json'
+                Body=json.dumps(manifest, separators=_COMPACT_JSON).encode('utf-8'),
+                ContentType='application/json',
+                ServerSideEncryption='AES256'
             )
             
             print(f"📋 Updated manifest with {len(latest_reports)} latest reports")
@@ -746,6 +1346,25 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
         except Exception as e:
             print(f"⚠️ Failed to update manifest: {e}")
     
+    def _latest_report_keys(self, s3, bucket, start_after=None, limit=10):
+        """Return the newest report keys (newest first) by paging through the listing"""
+        params = {'Bucket': bucket, 'Prefix': 'reports/', 'PaginationConfig': {'PageSize': 1000}}
+        if start_after:
+            params['StartAfter'] = start_after
+        
+        # Keep only the newest keys in a bounded min-heap (oldest on top)
+        heap = []
+        for page in s3.get_paginator('list_objects_v2').paginate(**params):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith('.json'):
+                    continue
+                if len(heap) < limit:
+                    heapq.heappush(heap, obj['Key'])
+                else:
+                    heapq.heappushpop(heap, obj['Key'])
+        
+        return sorted(heap, reverse=True)
+    
     def print_executive_summary(self, report):
         """Print executive summary for leadership"""
         print(f"\n📊 Organization Knowledge Base Analysis Summary:")
@@ -762,8 +1381,9 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             print(f"      • {standard}: {data['issues']} policy violations across {len(set(data['files']))} files")
         
         # Cache efficiency
-        cache_efficiency = ((10 - report['ai_calls']) / 10) * 100 if report['files_scanned'] > 0 else 0
-        print(f"   ⚡ Cache Efficiency: {cache_efficiency:.0f}% (${(0.02 - report['cost']):.4f} saved)")
+        max_calls = self.MAX_FILES_PER_RUN
+        cache_efficiency = ((max_calls - report['ai_calls']) / max_calls) * 100 if report['files_scanned'] > 0 else 0
+        print(f"   ⚡ Cache Efficiency: {cache_efficiency:.0f}% (${(self.UNCACHED_RUN_COST - report['cost']):.4f} saved)")
 
     def get_branch_name(self):
         """Get current git branch name"""
@@ -783,15 +1403,8 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
                 if branch and branch != 'HEAD':
                     return branch
             
-            # Fallback to git rev-parse (may return HEAD for detached state)
-            result = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], 
-                                  capture_output=True, text=True, timeout=5)
-            if result.returncode == 0:
-                branch = result.stdout.strip()
-                if branch and branch != 'HEAD':
-                    return branch
-                    
-            # If we get HEAD, try to get the actual branch name from remote
+            # Detached HEAD (symbolic-ref fails, rev-parse --abbrev-ref would only say "HEAD"):
+            # find the branch name from remote
             result = subprocess.run(['git', 'branch', '-r', '--contains', 'HEAD'], 
                                   capture_output=True, text=True, timeout=5)
             if result.returncode == 0:
@@ -870,41 +1483,46 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
                     'resultsPerPage': 2
                 }
                 
-                response = requests.get(url, params=params, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    for cve in data.get('vulnerabilities', []):
-                        cve_data = cve.get('cve', {})
-                        vuln_id = cve_data.get('id', 'Unknown')
-                        
-                        # Get CVSS score
-                        metrics = cve_data.get('metrics', {})
-                        cvss_score = 'Unknown'
-                        if 'cvssMetricV31' in metrics:
-                            cvss_score = metrics['cvssMetricV31'][0]['cvssData']['baseScore']
-                        elif 'cvssMetricV2' in metrics:
-                            cvss_score = metrics['cvssMetricV2'][0]['cvssData']['baseScore']
-                        
-                        description = cve_data.get('descriptions', [{}])[0].get('value', 'No description')
-                        
-                        cve_issues.append({
-                            'type': 'vulnerability',  # Dashboard expects this type
-                            'vulnerability_id': vuln_id,
-                            'pattern': pattern['pattern'],
-                            'package': f"{language}_{pattern['pattern']}",  # Dashboard expects package field
-                            'line': pattern['line'],
-                            'severity': self.get_cve_severity(cvss_score).upper(),  # Dashboard expects uppercase
-                            'cvss_score': cvss_score,
-                            'description': description[:150] + '...' if len(description) > 150 else description,
-                            'source': 'CVE'  # Dashboard expects 'CVE' not 'NIST_CVE_API'
-                        })
+                with self._nvd_lock:
+                    try:
+                        response = requests.get(url, params=params, timeout=10)
+                    finally:
+                        time.sleep(0.5)  # Rate limiting
                 
-                time.sleep(0.5)  # Rate limiting
+                response.raise_for_status()  # e.g. rate-limit 403s
+                data = response.json()
                 
+                for cve in data.get('vulnerabilities', []):
+                    cve_data = cve.get('cve', {})
+                    vuln_id = cve_data.get('id', 'Unknown')
+                    
+                    # Get CVSS score
+                    metrics = cve_data.get('metrics', {})
+                    cvss_score = 'Unknown'
+                    if 'cvssMetricV31' in metrics:
+                        cvss_score = metrics['cvssMetricV31'][0]['cvssData']['baseScore']
+                    elif 'cvssMetricV2' in metrics:
+                        cvss_score = metrics['cvssMetricV2'][0]['cvssData']['baseScore']
+                    
+                    description = cve_data.get('descriptions', [{}])[0].get('value', 'No description')
+                    
+                    cve_issues.append({
+                        'type': 'vulnerability',  # Dashboard expects this type
+                        'vulnerability_id': vuln_id,
+                        'pattern': pattern['pattern'],
+                        'package': f"{language}_{pattern['pattern']}",  # Dashboard expects package field
+                        'line': pattern['line'],
+                        'severity': self.get_cve_severity(cvss_score).upper(),  # Dashboard expects uppercase
+                        'cvss_score': cvss_score,
+                        'description': description[:150] + '...' if len(description) > 150 else description,
+                        'source': 'CVE'  # Dashboard expects 'CVE' not 'NIST_CVE_API'
+                    })
+            
             except Exception as e:
                 print(f"   ⚠️ CVE API error for pattern '{pattern['keyword']}': {e}")
+                # No answer is not "no CVEs"; the file's CVE check is repeated next run
+                with self._stats_lock:
+                    self.incomplete_cve_checks.add(filepath)
         
         if cve_issues:
             print(f"   📊 Found {len(cve_issues)} CVE matches for code patterns")
@@ -914,43 +1532,35 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
     def extract_vulnerable_patterns(self, code, language):
         """Extract potentially vulnerable code patterns"""
         patterns = []
-        lines = code.split('\n')
-        
-        if language == 'Python':
-            for i, line in enumerate(lines, 1):
-                if 'eval(' in line or 'exec(' in line:
-                    patterns.append({
-                        'pattern': 'eval/exec injection',
-                        'keyword': 'python eval exec injection',
-                        'line': i
-                    })
-                elif 'subprocess.call' in line and 'shell=True' in line:
-                    patterns.append({
-                        'pattern': 'command injection',
-                        'keyword': 'python subprocess shell injection',
-                        'line': i
-                    })
-                elif 'pickle.loads' in line:
-                    patterns.append({
-                        'pattern': 'deserialization',
-                        'keyword': 'python pickle deserialization',
-                        'line': i
-                    })
-        
-        elif language == 'JavaScript':
-            for i, line in enumerate(lines, 1):
-                if 'eval(' in line:
-                    patterns.append({
-                        'pattern': 'eval injection',
-                        'keyword': 'javascript eval injection',
-                        'line': i
-                    })
-                elif 'innerHTML' in line and '+' in line:
+        rules = _CVE_RULES.get(language)
+        if not rules:
+            return patterns
+        
+        # One compiled sweep finds candidate lines; each is classified once.
+        # Matches arrive in order, so line numbers are counted only since the last one.
+        line_end = -1
+        line_no = 1
+        counted_to = 0
+        for match in _CVE_TRIGGER_RE[language].finditer(code):
+            if match.start() < line_end:
+                continue  # Line already classified
+            
+            line_start = code.rfind('\n', 0, match.start()) + 1
+            line_end = code.find('\n', match.start())
+            if line_end == -1:
+                line_end = len(code)
+            line = code[line_start:line_end]
+            line_no += code.count('\n', counted_to, line_start)
+            counted_to = line_start
+            
+            for any_of, all_of, pattern, keyword in rules:
+                if any(m in line for m in any_of) and all(m in line for m in all_of):
                     patterns.append({
-                        'pattern': 'XSS vulnerability',
-                        'keyword': 'javascript innerHTML XSS',
-                        'line': i
+                        'pattern': pattern,
+                        'keyword': keyword,
+                        'line': line_no
                     })
+                    break
         
         return patterns
     
@@ -976,6 +1586,40 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
         with open('error_log.txt', 'a') as log_file:
             log_file.write(f"{datetime.now().isoformat()} - ERROR: {message}\n")
     
+    def find_files(self, extensions):
+        """Collect files with the given extensions in a single directory walk"""
+        by_ext = {ext: [] for ext in extensions}
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory or '.') as entries:
+                    for entry in entries:
+                        # Hidden entries were never matched by glob's **; vendored dirs are pruned
+                        if entry.name.startswith('.'):
+                            continue
+                        path = os.path.join(directory, entry.name) if directory else entry.name
+                        # Symlinked directories are not followed (no cycles, nothing outside the repo)
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in ('venv', 'node_modules'):
+                                pending.append(path)
+                        elif entry.is_file():
+                            ext = os.path.splitext(entry.name)[1]
+                            if ext not in by_ext:
+                                continue
+                            # Size comes from the stat cached on the entry - no extra getsize/read.
+                            # Empty files have nothing to scan; oversized ones (generated, minified) are skipped
+                            size = entry.stat().st_size
+                            if size > self.max_file_size:
+                                print(f"⏭️  Skipping {path} ({size} bytes > MAX_FILE_SIZE)")
+                            elif size > 0:
+                                by_ext[ext].append(path)
+            except OSError as e:
+                self.log_error(f"Directory scan error: {e}")
+        
+        # Keep files grouped in extension order, as the per-extension globs did
+        return [f for ext in extensions for f in by_ext[ext]]
+    
     def run(self, auto_fix=False):
         """Main compliance scan"""
         print(f"🧠 Organization Knowledge Base Security Analysis")
@@ -994,58 +1638,138 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
         print(f"Auto-fix: {'ON' if auto_fix else 'OFF'}\n")
         
         # Collect files
-        extensions = ['.py', '.js', '.ts', '.tf', '.tfvars', '.yaml', '.yml', '.java', '.go', '.sh']
-        files = []
-        for ext in extensions:
-            files.extend([f for f in glob.glob(f"**/*{ext}", recursive=True) 
-                         if not any(s in f for s in ['.git/', 'venv/', 'node_modules/', 'src/compliance_scanner.py'])])
+        files = [f for f in self.find_files(list(_LANGUAGE_BY_EXT))
+                 if not any(s in f for s in ['.git/', 'venv/', 'node_modules/', 'src/compliance_scanner.py'])]
         
         print(f"📁 Scanning {len(files)} files for compliance violations\n")
         
-        # Scan files
-        results = []
-        for f in files[:10]:  # Limit for cost
-            # Check cache first
-            cached_result = self.get_cached_result(f)
-            if cached_result:
+        # Read each file once; the bytes feed the prefilter and cache hash, and are
+        # decoded to text only for files that will actually be scanned
+        batch = files[:self.MAX_FILES_PER_RUN]  # Limit for cost
+        codes = {}
+        hashes = {}
+        cached = {}
+        first_seen = {}  # (content hash, extension) -> first file scanned with that content
+        duplicates = {}  # file -> earlier file with identical content
+        detections = {}  # file -> cached AI detection awaiting a CVE re-check
+        for f in batch:
+            data = self.read_bytes(f)
+            if data is None:
+                continue
+            
+            # A NUL near the start marks a binary file (or UTF-16 text), which cannot be scanned as source
+            if data.find(b'\0', 0, 64) != -1:
+                print(f"⏭️  Skipping {f} (binary file)")
+                continue
+            
+            if self.ai_prefilter and not _RISKY_RE.search(data):
+                print(f"⏭️  Skipping {f} (no security-relevant patterns)")
+                continue
+            hashes[f] = self.get_file_hash(f, data)
+            
+            # Serve unchanged files from cache, including ones previously found clean.
+            # A cached detection whose CVE check failed is reused; only the CVE check reruns.
+            entry = self.get_cache_entry(f, hashes[f])
+            if entry is not None and 'detection' in entry:
+                print(f"📋 Using cached AI detection for {f} (re-checking CVEs)")
+                detections[f] = entry['detection']
+            elif entry is not None:
                 print(f"📋 Using cached result for {f} (file unchanged)")
-                results.append(cached_result)
+                cached[f] = entry.get('result')
                 continue
             
-            # Scan file if not cached
-            result = self.scan_file(f, auto_fix)
-            if result:
-                # Cache the result
-                self.cache_result(f, result)
-                results.append(result)
-        
-        # Save cache after scanning
-        self.save_cache()
+            # Identical content (same extension, so same prompt) is scanned once per run
+            dedup_key = (hashes[f], os.path.splitext(f)[1])
+            if dedup_key in first_seen and f not in detections:
+                print(f"📋 {f} is identical to {first_seen[dedup_key]} - sharing its scan")
+                duplicates[f] = first_seen[dedup_key]
+                continue
+            
+            code = self.decode_source(f, data)
+            if code is not None:
+                codes[f] = code
+                first_seen[dedup_key] = f
+        
+        # Scan the rest concurrently - each scan is dominated by Bedrock round-trips
+        to_scan = [f for f in batch if f in codes and f not in detections]
+        scan_batches = self._plan_scan_batches(to_scan, codes) + [[f] for f in batch if f in detections and f in codes]
+        scanned = {}
+        # Workers' prints are grouped per batch instead of interleaving line by line
+        task_output = _TaskOutput(sys.stdout)
+        
+        def scan(group):
+            with task_output.task():
+                return self._scan_batch(group, codes, auto_fix, detections)
+        
+        sys.stdout = task_output
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for group, group_results in zip(scan_batches, executor.map(scan, scan_batches)):
+                    scanned.update(zip(group, group_results))
+        finally:
+            sys.stdout = task_output.stream
+        
+        # Duplicates share the original's result; a fix of identical content is identical, so copy it over
+        for f, original in duplicates.items():
+            result = scanned.get(original)
+            if original in self.incomplete_scans:
+                self.incomplete_scans.add(f)
+            if original in self.cve_pending:
+                self.cve_pending[f] = self.cve_pending[original]
+            if result and result['fixed']:
+                try:
+                    self.write_file_atomic(f, self.fixed_sources[original])
+                except OSError as e:
+                    self.log_error(f"File write error: {f}: {e}")
+                    result = dict(result, fixed=False)
+            scanned[f] = dict(result, filepath=f) if result else None
         
-        # Generate compliance report
+        # Collect results in file order, tallying the report totals in the same pass
+        results = []
         compliance_summary = {}
-        for result in results:
+        total_issues = 0
+        fixed_count = 0
+        by_severity = {'critical': 0, 'high': 0, 'medium': 0, 'low': 0}
+        for f in batch:
+            if f in cached:
+                result = cached[f]
+            elif f in scanned:
+                result = scanned[f]
+                # Cache the result against the content that was scanned (None = clean)
+                if f in self.cve_pending:
+                    self.cache_result(f, None, hashes[f], detection=self.cve_pending[f])
+                elif f not in self.incomplete_scans:
+                    self.cache_result(f, result, hashes[f])
+            else:
+                continue
+            if not result:
+                continue
+            results.append(result)
+            
+            issues = result['issues']
+            total_issues += len(issues)
+            if result['fixed']:
+                fixed_count += 1
+            
+            severity_counts = {}
+            for issue in issues:
+                severity = issue['severity']
+                severity_counts[severity] = severity_counts.get(severity, 0) + 1
+            for severity, count in severity_counts.items():
+                by_severity[severity] = by_severity.get(severity, 0) + count
+            
+            # Compliance report
             for violation in result.get('compliance_violations', []):
                 if violation not in compliance_summary:
                     compliance_summary[violation] = {'files': [], 'issues': 0, 'critical': 0, 'high': 0}
                 
                 compliance_summary[violation]['files'].append(result['filepath'])
-                compliance_summary[violation]['issues'] += len(result['issues'])
-                
-                for issue in result['issues']:
-                    if issue['severity'] == 'critical':
-                        compliance_summary[violation]['critical'] += 1
-                    elif issue['severity'] == 'high':
-                        compliance_summary[violation]['high'] += 1
+                compliance_summary[violation]['issues'] += len(issues)
+                compliance_summary[violation]['critical'] += severity_counts.get('critical', 0)
+                compliance_summary[violation]['high'] += severity_counts.get('high', 0)
         
-        # Summary
-        total_issues = sum(len(r['issues']) for r in results)
-        fixed_count = sum(1 for r in results if r['fixed'])
-        
-        by_severity = {'critical': 0, 'high': 0, 'medium': 0, 'low': 0}
-        for r in results:
-            for i in r['issues']:
-                by_severity[i['severity']] = by_severity.get(i['severity'], 0) + 1
+        # Save cache after scanning
+        self.save_cache()
         
         print(f"\n{'='*60}")
         print(f"📊 Compliance Scan Results")
@@ -1094,7 +1818,7 @@ Return ONLY the complete fixed code without any explanation comments. Do not add
             'fixed': fixed_count if auto_fix else 0,
             'by_severity': by_severity,
             'compliance_summary': compliance_summary,
-            'recent_scan_files': [os.path.basename(f) for f in files[:10]],  # Top 10 files scanned
+            'recent_scan_files': [os.path.basename(f) for f in batch],  # Files scanned this run
             'results': results
         }
         
@@ -1123,12 +1847,15 @@ if __name__ == "__main__":
     # Parse arguments
     profile_name = None
     auto_fix = False
+    use_cache = True
     
     for arg in sys.argv[1:]:
         if arg.startswith('--profile='):
             profile_name = arg.split('=')[1]
         elif arg == '--fix':
             auto_fix = True
+        elif arg == '--no-cache':
+            use_cache = False
     
-    scanner = ComplianceScanner(profile_name=profile_name)
+    scanner = ComplianceScanner(profile_name=profile_name, use_cache=use_cache)
     exit(scanner.run(auto_fix=auto_fix))
\ No newline at end of file